@@ -1,374 +1,603 @@
 import os
+import asyncio
 import json
-import requests
+import aiohttp
 from pathlib import Path
 from loguru import logger
 from telethon import TelegramClient, events
 from telethon.tl.custom import Button
+from telethon.tl.types import DocumentAttributeVideo
 import sys
+import time
+import hashlib
+import functools
+import contextlib
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from enum import IntEnum
 
 from config import (
-    API_ID, API_HASH, BOT_TOKEN, ID_WHITELIST,
-    COMFYUI_URL, COMFYUI_INPUT_DIR, COMFYUI_OUTPUT_DIR,
+    API_ID, API_HASH, BOT_TOKEN, ID_WHITELIST, SENDER_CACHE_TTL, SESSION_TTL,
+    FLOOD_SLEEP_THRESHOLD,
+    COMFYUI_URLS, COMFYUI_INPUT_DIR, COMFYUI_OUTPUT_DIR,
     GENERATION_TIMEOUT, WORKFLOW_FILE, SESSION_FILE,
-    MAX_FRAMES_PER_SEGMENT, MAX_TOTAL_FRAMES, DEFAULT_SEGMENT_FRAMES
+    MAX_FRAMES_PER_SEGMENT, MAX_TOTAL_FRAMES, DEFAULT_SEGMENT_FRAMES,
+    GENERATION_WORKERS, MAX_QUEUE_SIZE, VIDEO_CACHE_SIZE,
+    LOG_FILE, NO_STDOUT_LOG, ensure_dirs
 )
-from media_utils import is_image
-from long_video import LongVideoGenerator
+from media_utils import is_image, load_workflow_template, ping_comfyui
+from long_video import LongVideoGenerator, Segment
+from video_utils import get_video_info
+
+try:
+    import uvloop  # libuv-based event loop, used when available
+except ImportError:
+    uvloop = None
 
 # Configure loguru
+LOG_FORMAT = "<green>{time:YYYY-MM-DD HH:mm:ss}</green> | <level>{level: <8}</level> | <cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - <level>{message}</level>"
 logger.remove()  # Remove default handler
-logger.add(
-    sys.stdout,
-    format="<green>{time:YYYY-MM-DD HH:mm:ss}</green> | <level>{level: <8}</level> | <cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - <level>{message}</level>",
-    level="INFO",
-    colorize=True
-)
+if not NO_STDOUT_LOG:
+    logger.add(
+        sys.stdout,
+        format=LOG_FORMAT,
+        level="INFO",
+        colorize=sys.stdout.isatty(),
+        enqueue=True  # Format and write records on loguru's thread, not the event loop
+    )
+if LOG_FILE:
+    logger.add(
+        LOG_FILE,
+        format=LOG_FORMAT,
+        level="INFO",
+        rotation="100 MB",
+        compression="gz",
+        enqueue=True
+    )
+
+# The session file is opened as soon as the client is built, so its directory must exist first
+ensure_dirs()
+
+# Initialize bot; Telethon retries any request hitting a flood wait up to the threshold
+bot = TelegramClient(SESSION_FILE, API_ID, API_HASH, flood_sleep_threshold=FLOOD_SLEEP_THRESHOLD)
+
+# Shared ComfyUI HTTP session, created in main() once the loop is running
+HTTP_SESSION = None
+
+class State(IntEnum):
+    """What the bot expects from a user next"""
+    PROMPT = 1
+    IMAGE = 2
+    FRAMES = 3
+    SEGMENT_SETUP = 4
+    SEGMENT_PROMPT = 5
+
+@dataclass(slots=True)
+class UserSession:
+    """A user's conversation with the bot and the data collected for their video"""
+    mode: str  # 'short' or 'long'
+    state: State = State.PROMPT
+    prompt: str = ""
+    image_path: str = ""
+    frames: int = 0
+    segments: list[Segment] = field(default_factory=list)
+    total_frames: int = 0
+    temp_frames: int = 0
+    last_seen: float = field(default_factory=time.monotonic)
+
+# Keyboard buttons; the markup is built once and reused for every reply
+SHORT_VIDEO_BUTTON = "Short Video 🎬"
+LONG_VIDEO_BUTTON = "Long Video 🎥"
+PROCESS_VIDEO_BUTTON = "✅ Process Video"
+ADD_SEGMENT_BUTTON = "➕ Add Another Segment"
+MENU_MODES = {SHORT_VIDEO_BUTTON: 'short', LONG_VIDEO_BUTTON: 'long'}
+MENU_KEYBOARD = [
+    [Button.text(SHORT_VIDEO_BUTTON)],
+    [Button.text(LONG_VIDEO_BUTTON)]
+]
+SEGMENT_KEYBOARD = [
+    [Button.text(PROCESS_VIDEO_BUTTON)],
+    [Button.text(ADD_SEGMENT_BUTTON)]
+]
+
+# Conversations in progress; a user without an entry gets the menu
+SESSIONS = {}  # user_id -> UserSession
 
-# Initialize bot
-bot = TelegramClient(SESSION_FILE, API_ID, API_HASH).start(bot_token=BOT_TOKEN)
+# Uploaded images; the message id keeps a queued job's image from being overwritten
+INPUT_IMAGE_PATH = os.path.join(COMFYUI_INPUT_DIR, "input_{user_id}_{message_id}.jpg")
 
-# Conversation states
-WAITING_FOR = {}
-USER_DATA = {}
+# Pending generation jobs, drained by generation_worker tasks
+JOB_QUEUE = asyncio.Queue(maxsize=MAX_QUEUE_SIZE)
+
+# Media of videos already sent, reused for identical requests: request key -> media
+_VIDEO_CACHE = OrderedDict()
+
+# Sender usernames, only needed for logging: user_id -> (username, fetched_at)
+_SENDER_CACHE = {}
 
 def is_authorized(user_id):
     """Check if user is in whitelist"""
     return user_id in ID_WHITELIST
 
+def authorized(denial_message=None):
+    """Drop events from users outside the whitelist before any other work"""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(event):
+            if not is_authorized(event.sender_id):
+                logger.warning("Unauthorized message from user {}", event.sender_id)
+                if denial_message:
+                    await event.respond(denial_message)
+                return
+            return await handler(event)
+        return wrapper
+    return decorator
+
+async def get_username(event):
+    """Get the sender's username, resolving the sender at most once per TTL"""
+    user_id = event.sender_id
+    now = time.monotonic()
+    cached = _SENDER_CACHE.get(user_id)
+    if cached and now - cached[1] < SENDER_CACHE_TTL:
+        return cached[0]
+    
+    # Updates usually carry the sender already; only fetch it when they don't
+    user = event.sender or await event.get_sender()
+    username = getattr(user, 'username', None)
+    _SENDER_CACHE[user_id] = (username, now)
+    return username
+
 @bot.on(events.NewMessage(pattern='/start'))
+@authorized("You are not authorized to use this bot.")
 async def start_handler(event):
     """Handle /start command"""
-    user = await event.get_sender()
-    logger.info(f"Start command received from user {user.id} (@{user.username})")
+    username = await get_username(event)
+    logger.info("Start command received from user {} (@{})", event.sender_id, username)
     
-    if not is_authorized(event.sender_id):
-        logger.warning(f"Unauthorized access attempt from user {user.id} (@{user.username})")
-        return await event.respond("You are not authorized to use this bot.")
-    
-    keyboard = [
-        [Button.text("Short Video 🎬")],
-        [Button.text("Long Video 🎥")]
-    ]
-    await event.respond("Welcome! Choose an option:", buttons=keyboard)
+    await event.respond("Welcome! Choose an option:", buttons=MENU_KEYBOARD)
 
 @bot.on(events.NewMessage())
+@authorized()
 async def message_handler(event):
     """Handle all other messages"""
-    user = await event.get_sender()
-    user_id = user.id
-    
-    if not is_authorized(user_id):
-        logger.warning(f"Unauthorized message from user {user_id} (@{user.username})")
-        return
+    user_id = event.sender_id
+    username = await get_username(event)
+    # Per-message logs pass arguments so loguru only formats records it emits
+    logger.debug("Message received from user {} (@{}): {:.50}...", user_id, username, event.text)
     
-    logger.info(f"Message received from user {user_id} (@{user.username}): {event.text[:50]}...")
+    session = SESSIONS.get(user_id)
     
     # Handle the button press - clear previous state
-    if event.text in ["Short Video 🎬", "Long Video 🎥"]:
+    mode = MENU_MODES.get(event.text)
+    if mode:
         # Clear any previous state
-        WAITING_FOR[user_id] = 'prompt'
-        USER_DATA[user_id] = {'mode': 'short' if event.text == "Short Video 🎬" else 'long'}
+        SESSIONS[user_id] = UserSession(mode=mode)
+        if session:
+            await cleanup_user_data(user_id, session)
         await event.respond("Please enter a prompt describing the video you want to generate:")
         return
     
-    if user_id not in WAITING_FOR:
+    if session is None:
         # Add default response for messages outside the flow
-        keyboard = [
-            [Button.text("Short Video 🎬")],
-            [Button.text("Long Video 🎥")]
-        ]
-        await event.respond("Please choose an option from the menu:", buttons=keyboard)
+        await event.respond("Please choose an option from the menu:", buttons=MENU_KEYBOARD)
         return
     
-    state = WAITING_FOR[user_id]
-    logger.info(f"Processing state '{state}' for user {user_id} (@{user.username})")
-    
-    if state == 'prompt':
-        USER_DATA[user_id]['prompt'] = event.text
-        logger.info(f"Saved prompt for user {user_id}: {event.text}")
-        WAITING_FOR[user_id] = 'image'
-        await event.respond("Please send an image:")
-        return
-        
-    elif state == 'image':
-        if not await is_image(event.message):
-            logger.warning(f"Invalid image file received from user {user_id}")
-            return await event.respond("Please send a valid image file.")
-        
-        # Download image
-        try:
-            download_path = os.path.join(COMFYUI_INPUT_DIR, f"input_{user_id}.jpg")
-            await event.message.download_media(download_path)
-            
-            # Verify the file was actually downloaded
-            if not os.path.exists(download_path):
-                raise Exception("Failed to save the image")
-            
-            logger.info(f"Saved image from user {user_id} to: {download_path}")
-            USER_DATA[user_id]['image_path'] = download_path
-            
-            if USER_DATA[user_id]['mode'] == 'short':
-                WAITING_FOR[user_id] = 'frames'
-                await event.respond(f"Please enter the number of frames (2-{MAX_FRAMES_PER_SEGMENT}):")
-            else:
-                # Initialize long video data
-                USER_DATA[user_id].update({
-                    'segments': [],
-                    'total_frames': 0
-                })
-                WAITING_FOR[user_id] = 'segment_setup'
-                await event.respond(
-                    "Let's create your video segment by segment.\n\n"
-                    f"How many frames for segment 1? (2-{MAX_FRAMES_PER_SEGMENT})\n"
-                    f"Default: {DEFAULT_SEGMENT_FRAMES}"
-                )
-                
-        except Exception as e:
-            logger.error(f"Failed to save image for user {user_id}: {str(e)}")
-            await event.respond(f"Failed to save the image: {str(e)}")
-            WAITING_FOR[user_id] = 'image'
-            await event.respond("Please try sending the image again:")
-        return
-        
-    elif state == 'frames':
+    session.last_seen = time.monotonic()
+    logger.debug("Processing state '{}' for user {} (@{})", session.state.name, user_id, username)
+    await STATE_HANDLERS[session.state](event, user_id, session)
+
+async def handle_prompt(event, user_id, session):
+    """Save the initial prompt and ask for an image"""
+    if not event.text.strip():
+        # E.g. a photo without a caption; the job needs a prompt
+        return await event.respond("Please enter a text prompt describing the video you want to generate:")
+    session.prompt = event.text
+    logger.debug("Saved prompt for user {}: {}", user_id, event.text)
+    session.state = State.IMAGE
+    await event.respond("Please send an image:")
+
+async def download_image(message, path):
+    """Download a message's photo or document in 512 KiB requests, writing chunks off the event loop"""
+    # Write to a side file so a partial download never appears under the final name
+    part_path = path + '.part'
+    f = await asyncio.to_thread(open, part_path, 'wb')
+    try:
         try:
-            frames = int(event.text)
-            if not 2 <= frames <= MAX_FRAMES_PER_SEGMENT:
-                raise ValueError()
-        except ValueError:
-            logger.warning(f"Invalid frame count '{event.text}' received from user {user_id}")
-            return await event.respond(f"Please enter a valid number between 2-{MAX_FRAMES_PER_SEGMENT}.")
+            # The Photo or Document itself, which is_image judged; a link preview's
+            # MessageMediaWebPage wrapper can't be passed to iter_download.
+            # iter_download already requests Telegram's 512 KiB maximum per call
+            async for chunk in bot.iter_download(message.file.media):
+                await asyncio.to_thread(f.write, chunk)
+        finally:
+            await asyncio.to_thread(f.close)
+        await asyncio.to_thread(os.replace, part_path, path)
+    except Exception:
+        await asyncio.to_thread(remove_file, part_path)
+        raise
+
+async def handle_image(event, user_id, session):
+    """Download the source image and move on to frame selection"""
+    if not is_image(event.message):
+        logger.warning(f"Invalid image file received from user {user_id}")
+        return await event.respond("Please send a valid image file.")
+    
+    # Download image
+    try:
+        download_path = INPUT_IMAGE_PATH.format(user_id=user_id, message_id=event.message.id)
+        # Acknowledge while the download is in flight rather than after it; both run to
+        # completion, so a failed acknowledgement can't orphan a finishing download
+        acknowledged, downloaded = await asyncio.gather(
+            event.respond("Downloading your image..."),
+            download_image(event.message, download_path),
+            return_exceptions=True
+        )
+        if isinstance(downloaded, BaseException):
+            raise downloaded
+        if isinstance(acknowledged, BaseException):
+            logger.warning(f"Failed to acknowledge image of user {user_id}: {str(acknowledged)}")
         
-        USER_DATA[user_id]['frames'] = frames
-        await process_short_video(event, user_id)
-            
-    elif state == 'segment_setup':
-        try:
-            frames = int(event.text) if event.text.strip() else DEFAULT_SEGMENT_FRAMES
-            if not 2 <= frames <= MAX_FRAMES_PER_SEGMENT:
-                raise ValueError()
-            
-            # Check if adding these frames would exceed the maximum
-            new_total = USER_DATA[user_id]['total_frames'] + frames
-            if new_total > MAX_TOTAL_FRAMES:
-                return await event.respond(
-                    f"Adding {frames} frames would exceed the maximum total of {MAX_TOTAL_FRAMES} frames.\n"
-                    f"You currently have {USER_DATA[user_id]['total_frames']} frames.\n"
-                    f"You can add up to {MAX_TOTAL_FRAMES - USER_DATA[user_id]['total_frames']} more frames.\n\n"
-                    "Please enter a smaller number:"
-                )
-        except ValueError:
-            logger.warning(f"Invalid segment frame count '{event.text}' received from user {user_id}")
-            return await event.respond(
-                f"Please enter a valid number between 2-{MAX_FRAMES_PER_SEGMENT}, "
-                f"or press Enter to use the default ({DEFAULT_SEGMENT_FRAMES})."
-            )
+        if (SESSIONS.get(user_id) is not session or session.state is not State.IMAGE
+                or session.image_path):
+            # The user started over, or another image finished downloading first
+            await asyncio.to_thread(remove_file, download_path)
+            return
         
-        # Store frames temporarily
-        USER_DATA[user_id]['temp_frames'] = frames
+        logger.info(f"Saved image from user {user_id} to: {download_path}")
+        session.image_path = download_path
         
-        # Move to prompt state
-        WAITING_FOR[user_id] = 'segment_prompt'
-        if not USER_DATA[user_id]['segments']:  # First segment
-            # Use initial prompt for first segment
-            USER_DATA[user_id]['segments'].append({
-                'frames': frames,
-                'prompt': USER_DATA[user_id]['prompt']
-            })
-            USER_DATA[user_id]['total_frames'] = frames
-            
-            # Ask if user wants to add another segment
-            keyboard = [
-                [Button.text("✅ Process Video")],
-                [Button.text("➕ Add Another Segment")]
-            ]
-            await event.respond(
-                f"Segment 1 configured with {frames} frames.\n"
-                f"Total frames so far: {frames}\n\n"
-                "Would you like to add another segment or process the video?",
-                buttons=keyboard
-            )
+        if session.mode == 'short':
+            session.state = State.FRAMES
+            await event.respond(f"Please enter the number of frames (2-{MAX_FRAMES_PER_SEGMENT}):")
         else:
-            await event.respond(f"Enter a prompt for segment {len(USER_DATA[user_id]['segments']) + 1}:")
-            
-    elif state == 'segment_prompt':
-        if event.text == "✅ Process Video":
-            await process_long_video(event, user_id)
-            return
-        elif event.text == "➕ Add Another Segment":
-            WAITING_FOR[user_id] = 'segment_setup'
-            segment_num = len(USER_DATA[user_id]['segments']) + 1
-            frames_left = MAX_TOTAL_FRAMES - USER_DATA[user_id]['total_frames']
-            max_frames = min(MAX_FRAMES_PER_SEGMENT, frames_left)
-            
+            session.state = State.SEGMENT_SETUP
             await event.respond(
-                f"How many frames for segment {segment_num}? (2-{max_frames})\n"
-                f"Default: {min(DEFAULT_SEGMENT_FRAMES, max_frames)}\n\n"
-                f"Total frames so far: {USER_DATA[user_id]['total_frames']}"
+                "Let's create your video segment by segment.\n\n"
+                f"How many frames for segment 1? (2-{MAX_FRAMES_PER_SEGMENT})\n"
+                f"Default: {DEFAULT_SEGMENT_FRAMES}"
             )
-            return
-        
-        # Regular prompt handling
-        segment_num = len(USER_DATA[user_id]['segments']) + 1
-        frames = USER_DATA[user_id]['temp_frames']
-        
-        # Add the new segment
-        USER_DATA[user_id]['segments'].append({
-            'frames': frames,
-            'prompt': event.text
-        })
-        USER_DATA[user_id]['total_frames'] += frames
+            
+    except Exception as e:
+        logger.error(f"Failed to save image for user {user_id}: {str(e)}")
+        if SESSIONS.get(user_id) is session and session.state is State.IMAGE and not session.image_path:
+            await event.respond(f"Failed to save the image: {str(e)}\n\nPlease try sending the image again:")
+
+def parse_frame_count(text, default=None):
+    """Return the frame count in a message, or None unless it is 2-MAX_FRAMES_PER_SEGMENT"""
+    text = text.strip()
+    if not text and default is not None:
+        return default
+    # isdecimal() only passes strings int() can parse, so bad input never raises
+    if not text.isdecimal():
+        return None
+    frames = int(text)
+    return frames if 2 <= frames <= MAX_FRAMES_PER_SEGMENT else None
+
+async def handle_frames(event, user_id, session):
+    """Read the frame count for a short video and start processing"""
+    frames = parse_frame_count(event.text)
+    if frames is None:
+        logger.warning(f"Invalid frame count '{event.text}' received from user {user_id}")
+        return await event.respond(f"Please enter a valid number between 2-{MAX_FRAMES_PER_SEGMENT}.")
+    
+    session.frames = frames
+    await process_video(event, user_id, session)
+
+async def handle_segment_setup(event, user_id, session):
+    """Read the frame count for the next long video segment"""
+    frames = parse_frame_count(event.text, DEFAULT_SEGMENT_FRAMES)
+    if frames is None:
+        logger.warning(f"Invalid segment frame count '{event.text}' received from user {user_id}")
+        return await event.respond(
+            f"Please enter a valid number between 2-{MAX_FRAMES_PER_SEGMENT}, "
+            f"or press Enter to use the default ({DEFAULT_SEGMENT_FRAMES})."
+        )
+    
+    # Check if adding these frames would exceed the maximum
+    new_total = session.total_frames + frames
+    if new_total > MAX_TOTAL_FRAMES:
+        return await event.respond(
+            f"Adding {frames} frames would exceed the maximum total of {MAX_TOTAL_FRAMES} frames.\n"
+            f"You currently have {session.total_frames} frames.\n"
+            f"You can add up to {MAX_TOTAL_FRAMES - session.total_frames} more frames.\n\n"
+            "Please enter a smaller number:"
+        )
+    
+    # Store frames temporarily
+    session.temp_frames = frames
+    
+    # Move to prompt state
+    session.state = State.SEGMENT_PROMPT
+    if not session.segments:  # First segment
+        # Use initial prompt for first segment
+        session.segments.append(Segment(prompt=session.prompt, frames=frames))
+        session.total_frames = frames
         
         # Ask if user wants to add another segment
-        frames_left = MAX_TOTAL_FRAMES - USER_DATA[user_id]['total_frames']
-        keyboard = [
-            [Button.text("✅ Process Video")],
-            [Button.text("➕ Add Another Segment")] if frames_left >= 2 else []
-        ]
-        
         await event.respond(
-            f"Segment {segment_num} configured with {frames} frames.\n"
-            f"Total frames so far: {USER_DATA[user_id]['total_frames']}\n"
-            f"Frames remaining: {frames_left}\n\n"
+            f"Segment 1 configured with {frames} frames.\n"
+            f"Total frames so far: {frames}\n\n"
             "Would you like to add another segment or process the video?",
-            buttons=keyboard
+            buttons=SEGMENT_KEYBOARD
         )
-            
-    elif state == 'segment_frames':
-        try:
-            frames = int(event.text) if event.text.strip() else DEFAULT_SEGMENT_FRAMES
-            if not 2 <= frames <= MAX_FRAMES_PER_SEGMENT:
-                raise ValueError()
-        except ValueError:
-            logger.warning(f"Invalid segment frame count '{event.text}' received from user {user_id}")
-            return await event.respond(f"Please enter a valid number between 2-{MAX_FRAMES_PER_SEGMENT}.")
-        
-        current_segment = USER_DATA[user_id]['current_segment']
-        total_segments = USER_DATA[user_id]['total_segments']
-        
-        # Add segment data
-        USER_DATA[user_id]['segments'].append({'frames': frames})
-        
-        # Ask for prompt if not the last segment
-        if current_segment < total_segments - 1:
-            WAITING_FOR[user_id] = 'segment_prompt'
-            await event.respond(
-                f"For segment {current_segment + 1}/{total_segments}:\n"
-                "Enter a new prompt (or press Enter to use the previous one):"
-            )
-        else:
-            await process_long_video(event, user_id)
-            
-    elif state == 'segment_prompt':
-        current_segment = USER_DATA[user_id]['current_segment']
-        total_segments = USER_DATA[user_id]['total_segments']
-        
-        # Save prompt if provided
-        if event.text.strip():
-            USER_DATA[user_id]['segments'][current_segment]['prompt'] = event.text
-        
-        # Move to next segment
-        USER_DATA[user_id]['current_segment'] += 1
-        current_segment += 1
+    else:
+        await event.respond(f"Enter a prompt for segment {len(session.segments) + 1}:")
+
+async def handle_segment_prompt(event, user_id, session):
+    """Handle segment actions and prompts for the next long video segment"""
+    if event.text == PROCESS_VIDEO_BUTTON:
+        await process_video(event, user_id, session)
+        return
+    elif event.text == ADD_SEGMENT_BUTTON:
+        session.state = State.SEGMENT_SETUP
+        segment_num = len(session.segments) + 1
+        frames_left = MAX_TOTAL_FRAMES - session.total_frames
+        max_frames = min(MAX_FRAMES_PER_SEGMENT, frames_left)
         
-        WAITING_FOR[user_id] = 'segment_frames'
         await event.respond(
-            f"For segment {current_segment + 1}/{total_segments}:\n"
-            f"Enter number of frames (2-{MAX_FRAMES_PER_SEGMENT}, default {DEFAULT_SEGMENT_FRAMES}):"
+            f"How many frames for segment {segment_num}? (2-{max_frames})\n"
+            f"Default: {min(DEFAULT_SEGMENT_FRAMES, max_frames)}\n\n"
+            f"Total frames so far: {session.total_frames}"
         )
-
-async def process_short_video(event, user_id):
-    """Process a short video request"""
-    if 'prompt' not in USER_DATA[user_id] or 'image_path' not in USER_DATA[user_id]:
-        logger.error(f"State error for user {user_id}: missing prompt or image_path")
-        WAITING_FOR[user_id] = 'prompt'
-        USER_DATA[user_id] = {}
-        await event.respond("Sorry, something went wrong. Let's start over.")
-        await event.respond("Please enter a prompt describing the video you want to generate:")
         return
     
-    WAITING_FOR[user_id] = None
-    processing_msg = await event.respond("Processing your request... This may take a while.")
+    # Regular prompt handling
+    segment_num = len(session.segments) + 1
+    frames = session.temp_frames
     
-    try:
-        generator = LongVideoGenerator(COMFYUI_URL, WORKFLOW_FILE, GENERATION_TIMEOUT)
-        video_path = await generator.generate_video_segment(
-            USER_DATA[user_id]['prompt'],
-            USER_DATA[user_id]['image_path'],
-            USER_DATA[user_id]['frames']
-        )
-        
-        if os.path.exists(video_path):
-            logger.info(f"Sending video to user {user_id}: {video_path}")
-            await bot.send_file(event.chat_id, video_path)
-            logger.info(f"Video sent successfully to user {user_id}")
-            try:
-                os.remove(video_path)
-            except Exception as e:
-                logger.error(f"Failed to clean up video for user {user_id}: {str(e)}")
-        else:
-            logger.error(f"No output video found for user {user_id}")
-            await event.respond("No output video found.")
-            
-    except Exception as e:
-        logger.error(f"Error during processing for user {user_id}: {str(e)}")
-        await event.respond(f"An error occurred: {str(e)}")
-    finally:
-        await processing_msg.delete()
-        cleanup_user_data(user_id)
+    # Add the new segment
+    session.segments.append(Segment(prompt=event.text, frames=frames))
+    session.total_frames += frames
+    
+    # Ask if user wants to add another segment
+    frames_left = MAX_TOTAL_FRAMES - session.total_frames
+    keyboard = SEGMENT_KEYBOARD if frames_left >= 2 else SEGMENT_KEYBOARD[:1]
+    
+    await event.respond(
+        f"Segment {segment_num} configured with {frames} frames.\n"
+        f"Total frames so far: {session.total_frames}\n"
+        f"Frames remaining: {frames_left}\n\n"
+        "Would you like to add another segment or process the video?",
+        buttons=keyboard
+    )
+
+# Conversation state -> handler coroutine
+STATE_HANDLERS = {
+    State.PROMPT: handle_prompt,
+    State.IMAGE: handle_image,
+    State.FRAMES: handle_frames,
+    State.SEGMENT_SETUP: handle_segment_setup,
+    State.SEGMENT_PROMPT: handle_segment_prompt,
+}
 
-async def process_long_video(event, user_id):
-    """Process a long video request"""
-    if not all(key in USER_DATA[user_id] for key in ['prompt', 'image_path', 'segments']):
+async def process_video(event, user_id, session):
+    """Queue the user's video request once everything it needs is collected"""
+    if not (session.prompt and session.image_path and (session.mode == 'short' or session.segments)):
         logger.error(f"State error for user {user_id}: missing required data")
-        WAITING_FOR[user_id] = 'prompt'
-        USER_DATA[user_id] = {}
-        await event.respond("Sorry, something went wrong. Let's start over.")
-        await event.respond("Please enter a prompt describing the video you want to generate:")
+        await cleanup_user_data(user_id, session)
+        SESSIONS[user_id] = UserSession(mode=session.mode)
+        await event.respond(
+            "Sorry, something went wrong. Let's start over.\n\n"
+            "Please enter a prompt describing the video you want to generate:"
+        )
         return
     
-    WAITING_FOR[user_id] = None
-    processing_msg = await event.respond("Processing your request... This may take a while.")
+    await enqueue_job(event, user_id, session)
+
+async def enqueue_job(event, user_id, session):
+    """Hand the user's request over to the generation workers"""
+    if JOB_QUEUE.full():
+        logger.warning(f"Generation queue is full, rejecting request from user {user_id}")
+        return await event.respond("Too many videos are queued right now. Please try again later.")
+    
+    # One status message is edited from queued through processing to the result.
+    # If sending it fails, the session stays in place and the user can press process again
+    position = JOB_QUEUE.qsize() + 1
+    status_msg = await event.respond(f"⏳ Your request is queued (position {position}).")
     
+    if SESSIONS.get(user_id) is not session:
+        # Queued by a repeated press, or replaced by a new flow, while the message was sent
+        with contextlib.suppress(Exception):
+            await status_msg.delete()
+        return
+    
+    # The job owns the session from here on, so the user can start a new flow
+    del SESSIONS[user_id]
     try:
-        generator = LongVideoGenerator(COMFYUI_URL, WORKFLOW_FILE, GENERATION_TIMEOUT)
-        video_path = await generator.generate_long_video(
-            USER_DATA[user_id]['prompt'],
-            USER_DATA[user_id]['image_path'],
-            USER_DATA[user_id]['segments']
-        )
+        JOB_QUEUE.put_nowait({
+            'event': event,
+            'user_id': user_id,
+            'data': session,
+            'status_msg': status_msg
+        })
+    except asyncio.QueueFull:
+        # Filled up by other users while the status message was being sent
+        await status_msg.edit("Too many videos are queued right now. Please try again later.")
+        await cleanup_user_data(user_id, session)
+        return
+    logger.info(f"Queued generation for user {user_id} at position {position}")
+
+async def generation_worker(comfyui_url):
+    """Run queued generation jobs one at a time on the given ComfyUI instance"""
+    generator = LongVideoGenerator(comfyui_url, WORKFLOW_FILE, GENERATION_TIMEOUT, HTTP_SESSION)
+    while True:
+        job = await JOB_QUEUE.get()
+        try:
+            await run_job(job, generator)
+        except Exception as e:
+            logger.error(f"Generation job for user {job['user_id']} failed: {str(e)}")
+        finally:
+            JOB_QUEUE.task_done()
+
+async def run_job(job, generator):
+    """Generate the requested video and send it to the user"""
+    event, user_id, user_data = job['event'], job['user_id'], job['data']
+    status_msg = job['status_msg']
+    video_path = None
+    
+    try:
+        key = await asyncio.to_thread(request_key, user_data)
+        cached = _VIDEO_CACHE.get(key)
+        if cached is not None:
+            # Telegram already has this video, so send it again without uploading
+            logger.info(f"Sending cached video to user {user_id}")
+            try:
+                await bot.send_file(event.chat_id, cached)
+            except Exception as e:
+                # E.g. an expired file reference; drop the entry and generate afresh
+                logger.warning(f"Resending cached video to user {user_id} failed: {str(e)}")
+                _VIDEO_CACHE.pop(key, None)
+            else:
+                _VIDEO_CACHE.move_to_end(key)
+                await delete_status(status_msg, user_id)
+                return
         
-        if os.path.exists(video_path):
+        # Update the status while the job is already being submitted to ComfyUI
+        processing = asyncio.create_task(status_msg.edit("Processing your request... This may take a while."))
+        try:
+            if user_data.mode == 'short':
+                video_path = await generator.generate_video_segment(
+                    user_data.prompt,
+                    user_data.image_path,
+                    user_data.frames
+                )
+            else:
+                video_path = await generator.generate_long_video(
+                    user_data.prompt,
+                    user_data.image_path,
+                    user_data.segments
+                )
+        finally:
+            # The edit must land before the status message is edited again or deleted
+            await asyncio.gather(processing, return_exceptions=True)
+        
+        if await asyncio.to_thread(os.path.exists, video_path):
             logger.info(f"Sending video to user {user_id}: {video_path}")
-            await bot.send_file(event.chat_id, video_path)
+            sent = await send_video(event.chat_id, video_path)
+            remember_video(key, sent.media)
             logger.info(f"Video sent successfully to user {user_id}")
-            try:
-                os.remove(video_path)
-            except Exception as e:
-                logger.error(f"Failed to clean up video for user {user_id}: {str(e)}")
+            await delete_status(status_msg, user_id)
         else:
             logger.error(f"No output video found for user {user_id}")
-            await event.respond("No output video found.")
+            await status_msg.edit("No output video found.")
             
     except Exception as e:
         logger.error(f"Error during processing for user {user_id}: {str(e)}")
-        await event.respond(f"An error occurred: {str(e)}")
+        await status_msg.edit(f"An error occurred: {str(e)}")
     finally:
-        await processing_msg.delete()
-        cleanup_user_data(user_id)
+        # Sent or not, the generated file is no longer needed
+        if video_path:
+            try:
+                await asyncio.to_thread(remove_file, video_path)
+            except Exception as e:
+                logger.error(f"Failed to clean up video for user {user_id}: {str(e)}")
+        await cleanup_user_data(user_id, user_data)
+
+async def delete_status(status_msg, user_id):
+    """Remove a job's status message; the video is already sent, so failing here is harmless"""
+    try:
+        await status_msg.delete()
+    except Exception as e:
+        logger.warning(f"Failed to delete status message for user {user_id}: {str(e)}")
+
+async def send_video(chat_id, video_path):
+    """Upload a video in large parts and send it as a streamable video"""
+    # Without hachoir installed Telethon would send a 1x1, zero-length video attribute
+    info = await asyncio.to_thread(get_video_info, video_path)
+    attributes = [DocumentAttributeVideo(
+        duration=info['duration'], w=info['width'], h=info['height'], supports_streaming=True
+    )] if info else None
+    # Telethon picks 128 KiB parts below 100 MB; 512 KiB is the largest Telegram accepts
+    uploaded = await bot.upload_file(video_path, part_size_kb=512)
+    return await bot.send_file(
+        chat_id,
+        uploaded,
+        attributes=attributes,
+        mime_type='video/mp4',
+        supports_streaming=True
+    )
+
+def request_key(user_data):
+    """Hash everything that determines the generated video, including the image bytes"""
+    # The workflow uses a fixed seed, so equal inputs produce the same video
+    with open(user_data.image_path, 'rb') as f:
+        digest = hashlib.file_digest(f, 'sha256')
+    digest.update(repr((
+        # The workflow version, since an edited workflow is picked up without a restart
+        os.stat(WORKFLOW_FILE).st_mtime_ns,
+        user_data.mode,
+        user_data.prompt,
+        user_data.frames,
+        [(segment.prompt, segment.frames) for segment in user_data.segments]
+    )).encode())
+    return digest.hexdigest()
+
+def remember_video(key, media):
+    """Keep the sent media for a request, evicting the least recently used entry"""
+    _VIDEO_CACHE[key] = media
+    _VIDEO_CACHE.move_to_end(key)
+    if len(_VIDEO_CACHE) > VIDEO_CACHE_SIZE:
+        _VIDEO_CACHE.popitem(last=False)
 
-def cleanup_user_data(user_id):
-    """Clean up user data and temporary files"""
-    if user_id in USER_DATA:
+def remove_file(path):
+    """Delete a file, treating an already missing one as done"""
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(path)
+
+async def cleanup_user_data(user_id, user_data):
+    """Clean up temporary files of a finished request"""
+    if user_data.image_path:
         try:
-            if 'image_path' in USER_DATA[user_id]:
-                os.remove(USER_DATA[user_id]['image_path'])
-                logger.info(f"Cleaned up input image for user {user_id}")
+            await asyncio.to_thread(remove_file, user_data.image_path)
+            logger.info(f"Cleaned up input image for user {user_id}")
         except Exception as e:
             logger.error(f"Failed to clean up input image for user {user_id}: {str(e)}")
-        del USER_DATA[user_id]
+
+async def expire_idle_sessions():
+    """Drop conversations that have been idle for longer than SESSION_TTL"""
+    while True:
+        await asyncio.sleep(60)
+        cutoff = time.monotonic() - SESSION_TTL
+        # Detach every expired session before the first await can let users reply
+        expired = [(uid, session) for uid, session in SESSIONS.items() if session.last_seen < cutoff]
+        for user_id, _ in expired:
+            del SESSIONS[user_id]
+        for user_id, session in expired:
+            logger.info(f"Dropped idle conversation of user {user_id}")
+            await cleanup_user_data(user_id, session)
+
+async def main():
+    """Start the bot and keep one ComfyUI connection pool for its lifetime"""
+    global HTTP_SESSION
+    HTTP_SESSION = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=32, limit_per_host=8)
+    )
+    try:
+        # Log in, connect to ComfyUI and parse the workflow at the same time
+        await asyncio.gather(
+            bot.start(bot_token=BOT_TOKEN),
+            *(ping_comfyui(url, HTTP_SESSION) for url in COMFYUI_URLS),
+            asyncio.to_thread(load_workflow_template, WORKFLOW_FILE)
+        )
+        
+        # Spread workers across the ComfyUI instances, one in-flight job per worker
+        workers = [
+            asyncio.create_task(generation_worker(COMFYUI_URLS[i % len(COMFYUI_URLS)]))
+            for i in range(GENERATION_WORKERS)
+        ]
+        expiry = asyncio.create_task(expire_idle_sessions())
+        try:
+            logger.info(f"Bot started with {GENERATION_WORKERS} generation worker(s)...")
+            await bot.run_until_disconnected()
+        finally:
+            expiry.cancel()
+            for worker in workers:
+                worker.cancel()
+    finally:
+        await HTTP_SESSION.close()
 
 if __name__ == "__main__":
-    logger.info("Bot started...")
-    bot.run_until_disconnected() 
\ No newline at end of file
+    if uvloop:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
+ 
\ No newline at end of file
@@ -5,18 +5,39 @@ from pathlib import Path
 # Load environment variables
 load_dotenv()
 
+def _require(name):
+    """Return a mandatory environment variable, failing clearly when it is unset"""
+    value = os.getenv(name)
+    if not value:
+        raise RuntimeError(f"{name} is not set; add it to .env or the environment")
+    return value
+
 # Bot Configuration
-API_ID = int(os.getenv('API_ID'))
-API_HASH = os.getenv('API_HASH')
-BOT_TOKEN = os.getenv('BOT_TOKEN')
-ID_WHITELIST = set(int(id_) for id_ in os.getenv('ID_WHITELIST', '').split(',') if id_)
+API_ID = int(_require('API_ID'))
+API_HASH = _require('API_HASH')
+BOT_TOKEN = _require('BOT_TOKEN')
+ID_WHITELIST = frozenset(int(id_) for id_ in map(str.strip, os.getenv('ID_WHITELIST', '').split(',')) if id_)
+SENDER_CACHE_TTL = 300  # Seconds to reuse a resolved sender username
+SESSION_TTL = int(os.getenv('SESSION_TTL', 1800))  # Seconds before an idle conversation is dropped
+FLOOD_SLEEP_THRESHOLD = int(os.getenv('FLOOD_SLEEP_THRESHOLD', 300))  # Longest flood wait slept through automatically
 
 # ComfyUI Configuration
 COMFYUI_URL = os.getenv('COMFYUI_URL', 'http://192.168.100.11:8188')
+# Comma-separated ComfyUI instances (e.g. one per GPU) sharing the input/output dirs
+COMFYUI_URLS = [url.strip() for url in os.getenv('COMFYUI_URLS', COMFYUI_URL).split(',') if url.strip()]
 COMFYUI_INPUT_DIR = os.getenv('COMFYUI_INPUT_DIR', '/storage/comfyui/input')
 COMFYUI_OUTPUT_DIR = os.getenv('COMFYUI_OUTPUT_DIR', '/storage/comfyui/output')
 GENERATION_TIMEOUT = int(os.getenv('GENERATION_TIMEOUT', 3600))
 
+# Generation Queue Configuration
+GENERATION_WORKERS = int(os.getenv('GENERATION_WORKERS', len(COMFYUI_URLS)))  # Jobs generated concurrently
+MAX_QUEUE_SIZE = int(os.getenv('MAX_QUEUE_SIZE', 1024))  # Jobs waiting before new ones are rejected
+VIDEO_CACHE_SIZE = int(os.getenv('VIDEO_CACHE_SIZE', 256))  # Sent videos remembered for identical requests
+
+# Logging Configuration
+LOG_FILE = os.getenv('LOG_FILE')  # Optional rotating log file
+NO_STDOUT_LOG = bool(os.getenv('NO_STDOUT_LOG'))  # Skip the stdout sink, e.g. when only LOG_FILE is wanted
+
 # Workflow Configuration
 WORKFLOW_FILE = 'wan2.2_img_to_vid.json'
 
@@ -26,12 +47,12 @@ SESSION_FILE = f'{SESSION_DIR}/bot.session'
 
 # Video Generation Configuration
 MAX_FRAMES_PER_SEGMENT = 125  # Maximum frames per video segment
-DEFAULT_FPS = 20.0  # Default FPS for concatenated videos
 DEFAULT_SEGMENT_FRAMES = 100  # Default number of frames per segment
 MAX_TOTAL_FRAMES = 1000  # Maximum total frames for long video generation
+VIDEO_ENCODER = os.getenv('VIDEO_ENCODER', 'libx264')  # ffmpeg encoder for re-encoded joins, e.g. h264_nvenc
 
 # Image Configuration
-SUPPORTED_IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')
+SUPPORTED_IMAGE_EXTENSIONS = frozenset({'.png', '.jpg', '.jpeg', '.webp'})
 DEFAULT_HORIZONTAL_SIZE = (1280, 720)  # width, height for horizontal images
 DEFAULT_VERTICAL_SIZE = (720, 1280)  # width, height for vertical images
 
@@ -40,8 +61,7 @@ TEMP_DIR = Path('temp')
 TEMP_FRAME_PREFIX = 'last_frame_'
 TEMP_VIDEO_PREFIX = 'segment_'
 
-# Ensure required directories exist
-os.makedirs(SESSION_DIR, exist_ok=True)
-os.makedirs(COMFYUI_INPUT_DIR, exist_ok=True)
-os.makedirs(COMFYUI_OUTPUT_DIR, exist_ok=True)
-os.makedirs(TEMP_DIR, exist_ok=True) 
\ No newline at end of file
+def ensure_dirs():
+    """Create the directories the bot reads and writes; called by the entrypoint, not on import"""
+    for path in (SESSION_DIR, COMFYUI_INPUT_DIR, COMFYUI_OUTPUT_DIR, TEMP_DIR):
+        Path(path).mkdir(parents=True, exist_ok=True) 
\ No newline at end of file
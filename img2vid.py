@@ -1,10 +1,11 @@
-import json
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 import time
 import os
 
 # Configuration
-COMFYUI_URL = "http://192.168.100.11:8188"
+COMFYUI_URL = os.getenv('COMFYUI_URL', "http://192.168.100.11:8188")
 WORKFLOW_FILE = "wan2.2_img_to_vid.json"  # Your exported workflow file
 
 # Parameters to modify
@@ -14,48 +15,52 @@ NEW_WIDTH = 1280
 NEW_FRAMES = 101  # Number of frames to generate
 NEW_INPUT_IMAGE = "1000000231.jpg"  # Input image filename
 
+# One keep-alive connection for the submit and every poll instead of a handshake per request
+_SESSION = requests.Session()
+_SESSION.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=4))
+_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4))
+
 def modify_and_run_workflow():
     # Load workflow
     if not os.path.exists(WORKFLOW_FILE):
         print(f"Error: {WORKFLOW_FILE} not found!")
         return
     
-    with open(WORKFLOW_FILE, 'r') as f:
-        workflow = json.load(f)
+    with open(WORKFLOW_FILE, 'rb') as f:
+        workflow = orjson.loads(f.read())
+    
+    # Walk the workflow with an explicit stack: no Python frame per node, no recursion limit
+    def replace_in_dict(obj, replacements):
+        stack = [obj]
+        while stack:
+            obj = stack.pop()
+            if isinstance(obj, dict):
+                for key, value in obj.items():
+                    if isinstance(value, (dict, list)):
+                        stack.append(value)
+                    elif value in replacements:
+                        obj[key], message = replacements[value]
+                        print(message)
+            elif isinstance(obj, list):
+                stack.extend(obj)
     
-    # Function to recursively search and replace values
-    def replace_in_dict(obj, old_prompt, new_prompt, old_height, new_height, old_width, new_width, old_frames, new_frames, old_image, new_image):
-        if isinstance(obj, dict):
-            for key, value in obj.items():
-                if value == old_prompt:
-                    obj[key] = new_prompt
-                    print(f"✓ Updated prompt")
-                elif value == old_height or value == str(old_height):
-                    obj[key] = new_height
-                    print(f"✓ Updated height: {old_height} -> {new_height}")
-                elif value == old_width or value == str(old_width):
-                    obj[key] = new_width
-                    print(f"✓ Updated width: {old_width} -> {new_width}")
-                elif value == old_frames or value == str(old_frames):
-                    obj[key] = new_frames
-                    print(f"✓ Updated frames: {old_frames} -> {new_frames}")
-                elif value == old_image:
-                    obj[key] = new_image
-                    print(f"✓ Updated input image: {old_image} -> {new_image}")
-                else:
-                    replace_in_dict(value, old_prompt, new_prompt, old_height, new_height, old_width, new_width, old_frames, new_frames, old_image, new_image)
-        elif isinstance(obj, list):
-            for item in obj:
-                replace_in_dict(item, old_prompt, new_prompt, old_height, new_height, old_width, new_width, old_frames, new_frames, old_image, new_image)
+    # Old value -> (new value, log message); numbers also match their string form.
+    # setdefault keeps the first entry on a clash, matching the old elif order
+    replacements = {}
+    for old, new, message in [
+        ("a video of a beautiful blondie woman doing gymnastics on the floor", NEW_PROMPT, "✓ Updated prompt"),
+        (720, NEW_HEIGHT, f"✓ Updated height: 720 -> {NEW_HEIGHT}"),
+        (1280, NEW_WIDTH, f"✓ Updated width: 1280 -> {NEW_WIDTH}"),
+        (101, NEW_FRAMES, f"✓ Updated frames: 101 -> {NEW_FRAMES}"),
+        ("combined_opencv_last_frame.png", NEW_INPUT_IMAGE, f"✓ Updated input image: combined_opencv_last_frame.png -> {NEW_INPUT_IMAGE}"),
+    ]:
+        replacements.setdefault(old, (new, message))
+        if isinstance(old, int):
+            replacements.setdefault(str(old), (new, message))
     
     # Replace values
     print("Modifying workflow...")
-    replace_in_dict(workflow, 
-                   "a video of a beautiful blondie woman doing gymnastics on the floor", NEW_PROMPT,
-                   720, NEW_HEIGHT,
-                   1280, NEW_WIDTH,
-                   101, NEW_FRAMES,
-                   "combined_opencv_last_frame.png", NEW_INPUT_IMAGE)
+    replace_in_dict(workflow, replacements)
     
     # Send to ComfyUI
     print(f"\nSending to ComfyUI at {COMFYUI_URL}")
@@ -65,20 +70,21 @@ def modify_and_run_workflow():
     print(f"Input image: {NEW_INPUT_IMAGE}")
     
     try:
-        response = requests.post(f"{COMFYUI_URL}/prompt", 
-                               json={"prompt": workflow, "client_id": "python_client"})
+        response = _SESSION.post(f"{COMFYUI_URL}/prompt", 
+                               data=orjson.dumps({"prompt": workflow, "client_id": "python_client"}),
+                               headers={'Content-Type': 'application/json'})
         
         if response.status_code == 200:
-            result = response.json()
+            result = orjson.loads(response.content)
             prompt_id = result['prompt_id']
             print(f"✓ Queued successfully! Prompt ID: {prompt_id}")
             
             # Simple polling for completion
             print("Waiting for completion...")
             while True:
-                history_response = requests.get(f"{COMFYUI_URL}/history/{prompt_id}")
+                history_response = _SESSION.get(f"{COMFYUI_URL}/history/{prompt_id}")
                 if history_response.status_code == 200:
-                    history_data = history_response.json()
+                    history_data = orjson.loads(history_response.content)
                     if prompt_id in history_data:
                         print("✓ Generation completed!")
                         break
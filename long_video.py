@@ -1,23 +1,41 @@
 import os
+import uuid
+import asyncio
 import shutil
 from pathlib import Path
-from typing import List, Dict, Optional
-from datetime import datetime
+from typing import List, Dict
+from dataclasses import dataclass
 from loguru import logger
+from aiohttp import ClientSession
 
 from config import (
-    MAX_FRAMES_PER_SEGMENT, DEFAULT_FPS, TEMP_DIR,
+    MAX_FRAMES_PER_SEGMENT, TEMP_DIR, VIDEO_ENCODER,
     TEMP_FRAME_PREFIX, TEMP_VIDEO_PREFIX, COMFYUI_OUTPUT_DIR,
     COMFYUI_INPUT_DIR
 )
-from media_utils import process_image_to_video, wait_for_generation, get_latest_video
+from media_utils import (
+    process_image_to_video, connect_comfyui_events, wait_for_generation, find_output_video
+)
 from video_utils import extract_last_frame, concatenate_videos
 
 
+def _unique_suffix() -> str:
+    """Return a random temp file suffix; unlike a pid or timestamp it survives restarts and shared dirs"""
+    return uuid.uuid4().hex
+
+
+@dataclass(slots=True)
+class Segment:
+    """One segment of a long video"""
+    prompt: str
+    frames: int
+
+
 class LongVideoGenerator:
-    def __init__(self, comfyui_url: str, workflow_file: str, generation_timeout: int):
+    def __init__(self, comfyui_url: str, workflow_file: str, generation_timeout: int, session: ClientSession):
         """Initialize the long video generator"""
         self.comfyui_url = comfyui_url
+        self.session = session
         self.workflow_file = workflow_file
         self.generation_timeout = generation_timeout
         self.temp_dir = TEMP_DIR
@@ -26,45 +44,59 @@ class LongVideoGenerator:
         
     async def generate_video_segment(self, prompt: str, image_path: str, n_frames: int) -> str:
         """Generate a single video segment"""
+        video_path = await self._render_segment(prompt, image_path, n_frames)
+        return await self._stash_segment(video_path)
+    
+    async def _render_segment(self, prompt: str, image_path: str, n_frames: int) -> Path:
+        """Run the workflow once and return the video ComfyUI wrote to its output directory"""
         logger.info(f"Generating video segment with prompt: {prompt}, image: {image_path}, frames: {n_frames}")
         
-        # Process the image to video
-        prompt_id = await process_image_to_video(
-            prompt,
-            image_path,
-            n_frames,
-            self.comfyui_url,
-            self.workflow_file
-        )
-        logger.info(f"Got prompt ID from ComfyUI: {prompt_id}")
+        # Subscribe under a per-job client id before queueing, so the completion event can't be missed
+        client_id = uuid.uuid4().hex
+        ws = await connect_comfyui_events(self.comfyui_url, client_id, self.session)
+        try:
+            # Process the image to video
+            prompt_id = await process_image_to_video(
+                prompt,
+                image_path,
+                n_frames,
+                self.comfyui_url,
+                self.workflow_file,
+                self.session,
+                client_id
+            )
+            logger.info(f"Got prompt ID from ComfyUI: {prompt_id}")
+            
+            # Wait for generation to complete
+            history = await wait_for_generation(
+                prompt_id, self.comfyui_url, self.generation_timeout, self.session, ws
+            )
+        finally:
+            if ws is not None:
+                await ws.close()
         
-        # Wait for generation to complete
-        await wait_for_generation(prompt_id, self.comfyui_url, self.generation_timeout)
         logger.info("Generation completed, looking for output video")
         
         # Get the generated video
-        video_path = get_latest_video(COMFYUI_OUTPUT_DIR)
+        video_path = find_output_video(history, COMFYUI_OUTPUT_DIR)
         if not video_path:
             logger.error(f"No output video found in {COMFYUI_OUTPUT_DIR}")
             raise Exception("No output video found")
         
         logger.info(f"Found output video at: {video_path}")
-        
-        # Copy video to temp directory with unique name
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        segment_path = self.temp_dir / f"{TEMP_VIDEO_PREFIX}{timestamp}.mp4"
-        logger.info(f"Copying video from {video_path} to {segment_path}")
+        return video_path
+    
+    async def _stash_segment(self, video_path: Path) -> str:
+        """Move a generated video into the temp directory under a unique name"""
+        segment_path = self.temp_dir / f"{TEMP_VIDEO_PREFIX}{_unique_suffix()}.mp4"
+        logger.info(f"Moving video from {video_path} to {segment_path}")
         
         try:
-            shutil.copy2(str(video_path), str(segment_path))
-            logger.info(f"Successfully copied video to {segment_path}")
-            try:
-                os.remove(video_path)
-                logger.info(f"Successfully removed original video at {video_path}")
-            except Exception as e:
-                logger.warning(f"Failed to remove original video at {video_path}: {e}")
+            # A rename when both dirs share a filesystem; shutil falls back to copy and delete
+            await asyncio.to_thread(shutil.move, video_path, segment_path)
+            logger.info(f"Successfully moved video to {segment_path}")
         except Exception as e:
-            logger.error(f"Failed to copy video from {video_path} to {segment_path}: {e}")
+            logger.error(f"Failed to move video from {video_path} to {segment_path}: {e}")
             raise
         
         return str(segment_path)
@@ -73,68 +105,70 @@ class LongVideoGenerator:
         self,
         initial_prompt: str,
         initial_image: str,
-        segments_data: List[Dict[str, any]]
+        segments_data: List[Segment]
     ) -> str:
         """
         Generate a long video by concatenating multiple segments
         
-        segments_data: List of dicts with keys:
-            - frames: int (number of frames)
-            - prompt: Optional[str] (if None, uses previous prompt)
+        segments_data: Segments in playback order; an empty prompt
+            reuses the previous segment's prompt
         """
-        video_segments = []
+        moves = []
         current_image = initial_image
         current_prompt = initial_prompt
         temp_files_to_cleanup = []
+        output_path = None
         
         try:
             # Generate each segment
             for i, segment in enumerate(segments_data):
-                frames = segment['frames']
-                prompt = segment.get('prompt') or current_prompt
+                frames = segment.frames
+                prompt = segment.prompt or current_prompt
                 
                 # Generate video segment
-                video_path = await self.generate_video_segment(prompt, current_image, frames)
-                video_segments.append(video_path)
+                video_path = await self._render_segment(prompt, current_image, frames)
                 
                 # Extract last frame for next segment if not the last one
                 if i < len(segments_data) - 1:
-                    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
                     # Save last frame to ComfyUI input directory
-                    last_frame_name = f"{TEMP_FRAME_PREFIX}{timestamp}.png"
-                    last_frame_path = Path(COMFYUI_INPUT_DIR) / last_frame_name
+                    last_frame_name = f"{TEMP_FRAME_PREFIX}{_unique_suffix()}.png"
+                    last_frame_path = os.path.join(COMFYUI_INPUT_DIR, last_frame_name)
                     logger.info(f"Extracting last frame to ComfyUI input directory: {last_frame_path}")
-                    current_image = extract_last_frame(video_path, str(last_frame_path))
-                    temp_files_to_cleanup.append(str(last_frame_path))
+                    current_image = await asyncio.to_thread(extract_last_frame, str(video_path), last_frame_path)
+                    temp_files_to_cleanup.append(last_frame_path)
                     current_prompt = prompt
+                
+                # The next segment only needs the frame, so the move (a copy across
+                # mounts in Docker) runs while ComfyUI generates it
+                moves.append(asyncio.create_task(self._stash_segment(video_path)))
+            
+            video_segments = await asyncio.gather(*moves)
             
             # Concatenate all segments
             if len(video_segments) > 1:
-                output_path = self.temp_dir / f"final_{datetime.now().strftime('%Y%m%d_%H%M%S')}.mp4"
-                concatenate_videos(video_segments, str(output_path), DEFAULT_FPS)
-                return str(output_path)
+                output_path = str(self.temp_dir / f"final_{_unique_suffix()}.mp4")
+                # Keeps the workflow's frame rate so matching segments are joined by stream copy;
+                # the re-encode fallback is CPU-bound, and OpenCV and ffmpeg both run off the GIL
+                await asyncio.to_thread(
+                    concatenate_videos, video_segments, output_path, None, VIDEO_ENCODER
+                )
             else:
-                return video_segments[0]
+                output_path = video_segments[0]
+            return output_path
                 
         finally:
-            # Cleanup temporary files
-            self._cleanup_temp_files(video_segments)
-            # Clean up temporary frame files from ComfyUI input directory
-            for temp_file in temp_files_to_cleanup:
-                try:
-                    os.remove(temp_file)
-                    logger.info(f"Cleaned up temporary file: {temp_file}")
-                except Exception as e:
-                    logger.warning(f"Failed to clean up temporary file {temp_file}: {e}")
+            # Let moves still in flight land first so their files are cleaned up too.
+            # Only this job's intermediates: other workers may have segments in flight
+            stashed = await asyncio.gather(*moves, return_exceptions=True)
+            intermediates = [path for path in stashed if isinstance(path, str) and path != output_path]
+            await asyncio.to_thread(self._cleanup_temp_files, intermediates + temp_files_to_cleanup)
     
-    def _cleanup_temp_files(self, keep_files: Optional[List[str]] = None):
-        """Clean up temporary files except the ones in keep_files"""
-        keep_files = set(keep_files or [])
-        
-        for pattern in [f"{TEMP_FRAME_PREFIX}*", f"{TEMP_VIDEO_PREFIX}*"]:
-            for file in self.temp_dir.glob(pattern):
-                if str(file) not in keep_files:
-                    try:
-                        os.remove(file)
-                    except Exception:
-                        pass  # Ignore cleanup errors 
\ No newline at end of file
+    def _cleanup_temp_files(self, paths: List[str]):
+        """Delete the given temporary files, treating already missing ones as done"""
+        for path in paths:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"Failed to clean up temporary file {path}: {e}") 
\ No newline at end of file
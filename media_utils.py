@@ -1,13 +1,12 @@
 import os
-import json
-import magic
+import copy
+import orjson
+import functools
 import asyncio
-import requests
-from PIL import Image
+import aiohttp
+import imagesize
 from pathlib import Path
-from datetime import datetime
 from loguru import logger
-from telethon.tl.types import DocumentAttributeFilename
 
 from config import (
     SUPPORTED_IMAGE_EXTENSIONS,
@@ -15,124 +14,190 @@ from config import (
     DEFAULT_VERTICAL_SIZE
 )
 
-async def is_image(message):
+def is_image(message):
     """Check if message contains an image"""
-    if message.photo:
+    # Telethon's File wraps the photo or document with its MIME type and name resolved
+    file = message.file
+    if file is None:
+        return False
+    # Photos report image/jpeg; for documents Telegram's MIME type decides most outright
+    if (file.mime_type or '').startswith('image/'):
         return True
-    if message.document:
-        mime = magic.Magic(mime=True)
-        try:
-            filename = None
-            for attr in message.document.attributes:
-                if isinstance(attr, DocumentAttributeFilename):
-                    filename = attr.file_name
-                    break
-            if filename and filename.lower().endswith(SUPPORTED_IMAGE_EXTENSIONS):
-                return True
-            return message.document.mime_type and message.document.mime_type.startswith('image/')
-        except Exception:
-            return False
-    return False
+    # Only the extension is lower-cased, then a single set lookup
+    name = file.name
+    return bool(name) and os.path.splitext(name)[1].lower() in SUPPORTED_IMAGE_EXTENSIONS
 
-async def get_image_dimensions(file_path):
+def get_image_dimensions(file_path):
     """Get image dimensions and determine orientation"""
-    with Image.open(file_path) as img:
-        width, height = img.size
-        is_vertical = height > width
-        return DEFAULT_VERTICAL_SIZE if is_vertical else DEFAULT_HORIZONTAL_SIZE
+    # Reads just the header; Pillow is only needed for formats imagesize doesn't know
+    width, height = imagesize.get(file_path)
+    if width < 0:
+        from PIL import Image
+        with Image.open(file_path) as img:
+            width, height = img.size
+    is_vertical = height > width
+    return DEFAULT_VERTICAL_SIZE if is_vertical else DEFAULT_HORIZONTAL_SIZE
 
-async def process_image_to_video(prompt, image_path, n_frames, comfyui_url, workflow_file):
+# Placeholder values in the workflow file and the parameter each one stands for
+PROMPT_PLACEHOLDER = "a video of a beautiful blondie woman doing gymnastics on the floor"
+DIMENSION_PLACEHOLDERS = (720, "720", 1280, "1280")
+FRAMES_PLACEHOLDERS = (101, "101")
+IMAGE_PLACEHOLDER = "combined_opencv_last_frame.png"
+
+def index_workflow_params(obj, path=(), slots=None):
+    """Record the key path of every placeholder in a workflow, by parameter"""
+    if slots is None:
+        slots = {'prompt': [], 'width': [], 'height': [], 'frames': [], 'image': []}
+    if isinstance(obj, list):
+        # List items are node links like ["101", 0], never parameters; only look inside them
+        for index, item in enumerate(obj):
+            index_workflow_params(item, path + (index,), slots)
+        return slots
+    if not isinstance(obj, dict):
+        return slots
+    for key, value in obj.items():
+        if value == PROMPT_PLACEHOLDER:
+            slots['prompt'].append(path + (key,))
+        elif value in DIMENSION_PLACEHOLDERS:
+            # Dimension slots are told apart by whether the key names width or height
+            if isinstance(key, str) and key.lower().endswith('width'):
+                slots['width'].append(path + (key,))
+            elif isinstance(key, str) and key.lower().endswith('height'):
+                slots['height'].append(path + (key,))
+        elif value in FRAMES_PLACEHOLDERS:
+            slots['frames'].append(path + (key,))
+        elif value == IMAGE_PLACEHOLDER:
+            slots['image'].append(path + (key,))
+        else:
+            index_workflow_params(value, path + (key,), slots)
+    return slots
+
+def load_workflow_template(workflow_file):
+    """Return a workflow and its placeholder index, re-parsed only when the file changes"""
+    return _parse_workflow_template(workflow_file, os.stat(workflow_file).st_mtime_ns)
+
+@functools.lru_cache(maxsize=4)
+def _parse_workflow_template(workflow_file, mtime_ns):
+    """Load a workflow file and index its placeholders; callers must copy before mutating"""
+    with open(workflow_file, 'rb') as f:
+        workflow = orjson.loads(f.read())
+    return workflow, index_workflow_params(workflow)
+
+def set_workflow_param(workflow, path, value):
+    """Set the value at a key path recorded by index_workflow_params"""
+    for key in path[:-1]:
+        workflow = workflow[key]
+    workflow[path[-1]] = value
+
+async def process_image_to_video(prompt, image_path, n_frames, comfyui_url, workflow_file, session,
+                                 client_id="telegram_bot"):
     """Process image using ComfyUI workflow"""
-    target_width, target_height = await get_image_dimensions(image_path)
+    # Opening the image is file I/O, so it runs off the event loop
+    target_width, target_height = await asyncio.to_thread(get_image_dimensions, image_path)
     
-    # Load workflow template
-    with open(workflow_file, 'r') as f:
-        workflow = json.load(f)
+    # Copy the cached workflow template
+    template, slots = load_workflow_template(workflow_file)
+    workflow = copy.deepcopy(template)
     
     # Update workflow parameters
-    def update_workflow_params(obj):
-        if isinstance(obj, dict):
-            for key, value in obj.items():
-                if value == "a video of a beautiful blondie woman doing gymnastics on the floor":
-                    obj[key] = prompt
-                elif value in [720, "720", 1280, "1280"]:
-                    # Update dimension based on whether it's width or height in the workflow
-                    if key.lower().endswith('width'):
-                        obj[key] = target_width
-                    elif key.lower().endswith('height'):
-                        obj[key] = target_height
-                elif value in [101, "101"]:
-                    obj[key] = n_frames
-                elif isinstance(value, str) and value == "combined_opencv_last_frame.png":
-                    obj[key] = os.path.basename(image_path)
-                else:
-                    update_workflow_params(value)
-        elif isinstance(obj, list):
-            for item in obj:
-                update_workflow_params(item)
-
-    update_workflow_params(workflow)
+    values = {
+        'prompt': prompt,
+        'width': target_width,
+        'height': target_height,
+        'frames': n_frames,
+        'image': os.path.basename(image_path),
+    }
+    for param, paths in slots.items():
+        for path in paths:
+            set_workflow_param(workflow, path, values[param])
     
     # Send to ComfyUI
     try:
-        response = requests.post(f"{comfyui_url}/prompt",
-                               json={"prompt": workflow, "client_id": "telegram_bot"})
-        
-        if response.status_code == 200:
-            return response.json()['prompt_id']
-        
-        raise Exception(f"Error: {response.status_code} - {response.text}")
+        body = orjson.dumps({"prompt": workflow, "client_id": client_id})
+        async with session.post(f"{comfyui_url}/prompt", data=body,
+                                headers={'Content-Type': 'application/json'}) as response:
+            if response.status == 200:
+                return (await response.json())['prompt_id']
+            
+            raise Exception(f"Error: {response.status} - {await response.text()}")
             
     except Exception as e:
         raise Exception(f"Failed to process image: {str(e)}")
 
-async def wait_for_generation(prompt_id, comfyui_url, timeout):
-    """Wait for generation to complete with timeout"""
-    logger.info(f"Waiting for generation to complete for prompt ID: {prompt_id}")
-    start_time = asyncio.get_event_loop().time()
-    
+async def ping_comfyui(comfyui_url, session):
+    """Open a connection to ComfyUI ahead of the first job"""
+    try:
+        async with session.get(f"{comfyui_url}/system_stats",
+                               timeout=aiohttp.ClientTimeout(total=10)) as response:
+            logger.info(f"ComfyUI at {comfyui_url} responded with status {response.status}")
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.warning(f"ComfyUI at {comfyui_url} is not reachable yet: {str(e)}")
+
+async def connect_comfyui_events(comfyui_url, client_id, session):
+    """Subscribe to ComfyUI's events for a client id; None means fall back to polling"""
+    try:
+        return await session.ws_connect(f"{comfyui_url}/ws", params={'clientId': client_id}, heartbeat=30)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.warning(f"ComfyUI event socket unavailable, polling history instead: {str(e)}")
+        return None
+
+async def wait_for_completion_event(ws, prompt_id):
+    """Read ComfyUI events until the prompt finishes or the socket closes"""
+    async for msg in ws:
+        if msg.type != aiohttp.WSMsgType.TEXT:
+            continue  # Binary messages carry preview images
+        event = orjson.loads(msg.data)
+        data = event.get('data') or {}
+        if data.get('prompt_id') != prompt_id:
+            continue
+        if event['type'] in ('execution_error', 'execution_interrupted'):
+            raise Exception(f"ComfyUI {event['type'].replace('_', ' ')}: {data.get('exception_message', '')}")
+        # ComfyUI reports the end of a prompt as executing no node
+        if event['type'] == 'executing' and data.get('node') is None:
+            return
+
+async def poll_history(prompt_id, comfyui_url, session):
+    """Poll ComfyUI's history until the prompt shows up in it and return its entry"""
     while True:
-        if asyncio.get_event_loop().time() - start_time > timeout:
-            logger.error(f"Generation timed out after {timeout} seconds")
-            raise TimeoutError("Generation timed out")
-        
-        history_response = requests.get(f"{comfyui_url}/history/{prompt_id}")
-        if history_response.status_code == 200:
-            history_data = history_response.json()
-            logger.debug(f"History response for {prompt_id}: {history_data}")
-            
-            if prompt_id in history_data:
-                logger.info(f"Generation completed for prompt ID: {prompt_id}")
-                return True
-        else:
-            logger.warning(f"Failed to get history for prompt {prompt_id}: {history_response.status_code}")
+        async with session.get(f"{comfyui_url}/history/{prompt_id}") as history_response:
+            if history_response.status == 200:
+                history_data = await history_response.json()
+                # Formatted by loguru only if a sink takes debug records, not per poll
+                logger.debug("History response for {}: {}", prompt_id, history_data)
+                
+                if prompt_id in history_data:
+                    return history_data[prompt_id]
+            else:
+                logger.warning(f"Failed to get history for prompt {prompt_id}: {history_response.status}")
         
         await asyncio.sleep(3)
 
-def get_latest_video(output_dir):
-    """Get the latest video file from the output directory"""
-    logger.info(f"Looking for latest video in {output_dir}")
-    output_dir = Path(output_dir)
-    
-    # First try date-based directory
-    today = "2025-08-12"
-    date_dir = output_dir / today
-    
-    video_files = []
-    
-    # Check date directory if it exists
-    if date_dir.exists():
-        logger.info(f"Checking date directory: {date_dir}")
-        video_files.extend(list(date_dir.glob('*.mp4')))
+async def wait_for_generation(prompt_id, comfyui_url, timeout, session, ws=None):
+    """Wait for generation to complete with timeout and return the prompt's history entry"""
+    logger.info(f"Waiting for generation to complete for prompt ID: {prompt_id}")
+    try:
+        async with asyncio.timeout(timeout):
+            if ws is not None:
+                await wait_for_completion_event(ws, prompt_id)
+            # After a completion event the first history request already has the outputs
+            history = await poll_history(prompt_id, comfyui_url, session)
+    except TimeoutError:
+        logger.error(f"Generation timed out after {timeout} seconds")
+        raise TimeoutError("Generation timed out")
     
-    # Also check root directory
-    logger.info(f"Checking root directory: {output_dir}")
-    video_files.extend(list(output_dir.glob('*.mp4')))
+    logger.info(f"Generation completed for prompt ID: {prompt_id}")
+    return history
+
+def find_output_video(history, output_dir):
+    """Get the path of the video a finished prompt saved, from its history entry"""
+    for node_output in history.get('outputs', {}).values():
+        for files in node_output.values():
+            if not isinstance(files, list):
+                continue
+            for file in files:
+                if isinstance(file, dict) and file.get('type') == 'output' \
+                        and file.get('filename', '').endswith('.mp4'):
+                    return Path(output_dir) / file.get('subfolder', '') / file['filename']
     
-    if video_files:
-        latest_video = max(video_files, key=lambda x: x.stat().st_mtime)
-        logger.info(f"Found latest video: {latest_video}")
-        return latest_video
-        
-    logger.warning(f"No video files found in {output_dir} or {date_dir}")
-    return None 
\ No newline at end of file
+    logger.warning(f"No output video listed in history outputs: {history.get('outputs')}")
+    return None
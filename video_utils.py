@@ -1,11 +1,37 @@
+import av
 import cv2
+import numpy as np
 import os
+import shutil
+import subprocess
+import tempfile
 from pathlib import Path
 from typing import List, Dict, Optional, Union
 
 
-def get_video_info(video_path: str) -> Optional[Dict[str, Union[float, int]]]:
+def get_video_info(video_path: str) -> Optional[Dict[str, Union[float, int, str]]]:
     """Get video properties"""
+    # The container header has everything, so nothing is decoded or estimated
+    try:
+        with av.open(video_path) as container:
+            stream = container.streams.video[0]
+            fps = float(stream.average_rate or 0)
+            if stream.duration is not None:
+                duration = float(stream.duration * stream.time_base)
+            else:
+                duration = (container.duration or 0) / av.time_base
+            return {
+                'codec': stream.codec_context.name,
+                'fps': fps,
+                'width': stream.width,
+                'height': stream.height,
+                'frame_count': stream.frames or round(duration * fps),
+                'duration': duration
+            }
+    except (av.FFmpegError, IndexError):
+        pass
+    
+    # Fall back to OpenCV's estimates for files PyAV can't read
     cap = cv2.VideoCapture(video_path)
     
     if not cap.isOpened():
@@ -16,8 +42,10 @@ def get_video_info(video_path: str) -> Optional[Dict[str, Union[float, int]]]:
         width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
         height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
         frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        codec = int(cap.get(cv2.CAP_PROP_FOURCC))
         
         return {
+            'codec': codec,
             'fps': fps,
             'width': width,
             'height': height,
@@ -28,11 +56,41 @@ def get_video_info(video_path: str) -> Optional[Dict[str, Union[float, int]]]:
         cap.release()
 
 
+def _extract_last_frame_ffmpeg(video_path: str, output_path: str) -> bool:
+    """Save the last frame with ffmpeg, decoding only the final second; False if that isn't possible"""
+    ffmpeg = shutil.which('ffmpeg')
+    if not ffmpeg:
+        return False
+    
+    # -sseof seeks from the end by container timestamps, and -update keeps
+    # overwriting the image so the last decoded frame is what remains
+    result = subprocess.run(
+        [ffmpeg, '-y', '-loglevel', 'error', '-sseof', '-1', '-i', video_path,
+         '-update', '1', output_path],
+        capture_output=True
+    )
+    return result.returncode == 0 and os.path.exists(output_path)
+
+
 def extract_last_frame(video_path: str, output_path: Optional[str] = None) -> str:
     """Extract the last frame from a video and save as PNG."""
     if not os.path.exists(video_path):
         raise FileNotFoundError(f"Video file not found: {video_path}")
     
+    # Generate output filename if not provided
+    if output_path is None:
+        video_name = Path(video_path).stem
+        output_path = f"{video_name}_last_frame.png"
+    
+    # Ensure output directory exists
+    output_dir = os.path.dirname(output_path)
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    
+    if _extract_last_frame_ffmpeg(video_path, output_path):
+        return output_path
+    
+    # Without ffmpeg, seek with OpenCV's frame index instead
     cap = cv2.VideoCapture(video_path)
     
     if not cap.isOpened():
@@ -69,16 +127,6 @@ def extract_last_frame(video_path: str, output_path: Optional[str] = None) -> st
     finally:
         cap.release()
     
-    # Generate output filename if not provided
-    if output_path is None:
-        video_name = Path(video_path).stem
-        output_path = f"{video_name}_last_frame.png"
-    
-    # Ensure output directory exists
-    output_dir = os.path.dirname(output_path)
-    if output_dir and not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-    
     # Save the frame as PNG
     if not cv2.imwrite(output_path, frame):
         raise ValueError(f"Could not save frame to: {output_path}")
@@ -86,8 +134,95 @@ def extract_last_frame(video_path: str, output_path: Optional[str] = None) -> st
     return output_path
 
 
-def concatenate_videos(video_paths: List[str], output_path: str, target_fps: Optional[float] = None) -> bool:
-    """Concatenate multiple videos using OpenCV"""
+def _concat_stream_copy(video_paths: List[str], output_path: str) -> bool:
+    """Join videos with ffmpeg's concat demuxer without re-encoding; False if that isn't possible"""
+    ffmpeg = shutil.which('ffmpeg')
+    if not ffmpeg:
+        return False
+    
+    list_path = f"{output_path}.txt"
+    with open(list_path, 'w') as f:
+        for video_path in video_paths:
+            escaped = os.path.abspath(video_path).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+    
+    try:
+        result = subprocess.run(
+            [ffmpeg, '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', list_path,
+             '-c', 'copy', '-movflags', '+faststart', output_path],
+            capture_output=True
+        )
+    finally:
+        os.remove(list_path)
+    
+    return result.returncode == 0
+
+
+class _FfmpegWriter:
+    """Pipe raw BGR frames into an ffmpeg encoder; used like cv2.VideoWriter"""
+    
+    def __init__(self, ffmpeg: str, output_path: str, fps: float, size: tuple, encoder: str):
+        width, height = size
+        self.encoder = encoder
+        # A file rather than a pipe, so ffmpeg can't stall on a full stderr buffer mid-encode
+        self.stderr = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(
+            [ffmpeg, '-y', '-loglevel', 'error',
+             '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}', '-r', str(fps), '-i', 'pipe:',
+             '-c:v', encoder, '-pix_fmt', 'yuv420p', '-movflags', '+faststart', output_path],
+            stdin=subprocess.PIPE,
+            stderr=self.stderr
+        )
+        self.returncode = None
+        self.error_output = ''
+    
+    def isOpened(self) -> bool:
+        return self.process.poll() is None
+    
+    def write(self, frame: np.ndarray):
+        # OpenCV frames are contiguous, so the buffer goes to the pipe without a copy
+        try:
+            self.process.stdin.write(frame.data)
+        except BrokenPipeError:
+            # ffmpeg exited early, e.g. an encoder this host can't run
+            self.release()
+            self.check()
+            raise
+    
+    def release(self):
+        if self.returncode is None:
+            try:
+                self.process.stdin.close()
+            except BrokenPipeError:
+                pass
+            self.returncode = self.process.wait()
+            self.stderr.seek(0)
+            self.error_output = self.stderr.read().decode(errors='replace').strip()
+            self.stderr.close()
+    
+    def check(self):
+        """Raise with ffmpeg's own message if the encoder failed; call after release"""
+        if self.returncode:
+            raise ValueError(
+                f"ffmpeg {self.encoder} encoder exited with status {self.returncode}: {self.error_output}"
+            )
+
+
+def concatenate_videos(
+    video_paths: List[str],
+    output_path: str,
+    target_fps: Optional[float] = None,
+    encoder: str = 'libx264'
+) -> bool:
+    """
+    Concatenate multiple videos
+    
+    Videos sharing codec, size and frame rate are joined by stream copy;
+    anything else is decoded with OpenCV and re-encoded by ffmpeg, or by
+    OpenCV's mp4v writer when ffmpeg is missing.
+    target_fps: Output frame rate; None keeps the first video's rate
+    encoder: ffmpeg video encoder for the re-encode, e.g. h264_nvenc
+    """
     if len(video_paths) < 2:
         raise ValueError("Need at least 2 videos to concatenate")
     
@@ -101,17 +236,34 @@ def concatenate_videos(video_paths: List[str], output_path: str, target_fps: Opt
     if not first_video_info:
         raise ValueError("Could not read first video properties")
     
-    output_fps = target_fps or 20.0
+    # Segments from the same workflow normally match, so no frame needs decoding
+    infos = [first_video_info] + [get_video_info(video_path) for video_path in video_paths[1:]]
+    signatures = {
+        (info['codec'], info['width'], info['height'], info['fps']) if info else None
+        for info in infos
+    }
+    same_fps = target_fps is None or target_fps == first_video_info['fps']
+    if len(signatures) == 1 and same_fps and _concat_stream_copy(video_paths, output_path):
+        return True
+    
+    output_fps = target_fps or first_video_info['fps'] or 20.0
     output_width = first_video_info['width']
     output_height = first_video_info['height']
     
     # Create output video writer
-    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-    out = cv2.VideoWriter(output_path, fourcc, output_fps, (output_width, output_height))
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg:
+        out = _FfmpegWriter(ffmpeg, output_path, output_fps, (output_width, output_height), encoder)
+    else:
+        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+        out = cv2.VideoWriter(output_path, fourcc, output_fps, (output_width, output_height))
     
     if not out.isOpened():
         raise ValueError("Could not create output video file")
     
+    # Reused as the target of every resize instead of allocating a frame per call
+    resized = np.empty((output_height, output_width, 3), dtype=np.uint8)
+    
     try:
         for video_path in video_paths:
             cap = cv2.VideoCapture(video_path)
@@ -121,14 +273,23 @@ def concatenate_videos(video_paths: List[str], output_path: str, target_fps: Opt
                 if not ret:
                     break
                 
-                # Resize if needed
+                # Resize if needed; INTER_AREA is the fast, alias-free filter for shrinking
                 if frame.shape[1] != output_width or frame.shape[0] != output_height:
-                    frame = cv2.resize(frame, (output_width, output_height))
+                    shrinking = frame.shape[1] > output_width or frame.shape[0] > output_height
+                    frame = cv2.resize(
+                        frame,
+                        (output_width, output_height),
+                        dst=resized,
+                        interpolation=cv2.INTER_AREA if shrinking else cv2.INTER_LINEAR
+                    )
                 
                 out.write(frame)
             
             cap.release()
         
+        out.release()
+        if isinstance(out, _FfmpegWriter):
+            out.check()
         return True
         
     except Exception as e: